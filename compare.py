@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import tempfile
+import contextlib
+
+from pyquaternion import Quaternion
+
+import vmd
+import reference
+
+'''
+Checks that the converters in vmd.py produce the same VAM scene as the original implementation (reference.py),
+and how much faster they are.
+
+Every engine converts every motion of the corpus (a few synthetic motions plus any .vmd files given). The
+resulting scenes are compared bone by bone and step by step with the reference one, or with another engine's when
+the reference has nothing to compare with. Run:
+
+    python compare.py [motion.vmd ...]
+'''
+
+# VAM base.json scene file location
+VAM_SCENE_BASE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'base.json')
+
+# Folder with sample motion files (*.vmd) to add to the corpus.
+SAMPLE_MOTIONS_DIR = ''
+
+# How many random motions to generate. Half of them use leg IK bones.
+SYNTHETIC_MOTIONS = 4
+
+# Length in frames of the random motions.
+SYNTHETIC_FRAMES = 900
+
+# Runs of each engine per motion, the fastest one is used for the speedup.
+REPEATS = 1
+
+# Step rates checked for the resampler, at least some of them must fall in between MMD frames.
+RESAMPLING_RATES = [15, 24, 60]
+
+# Frames per chunk for the chunked engines.
+CHUNK_FRAMES = 100
+
+# Frames (both included) converted by the window engines, compared with the same frames of the full motion.
+WINDOW = (250, 500)
+
+# Settings the reference runs with for the transforms file engine. The file holds the same values, so both
+# should match.
+TRANSFORMS_FILE_SETTINGS = {
+    'MMD_ARM_ROTATION': 0.5,
+    'HEELS': True,
+    'MMD_HEEL_ROTATION': 0.7,
+    'MMD_CENTER_HEIGHT_OFFSET': 0.1,
+    'MMD_CENTER_Z_OFFSET': -0.02,
+}
+
+# Largest difference allowed for a position or rotation component (VAM units) and for a time step (seconds).
+# Rotations q and -q are the same rotation, so the sign of a rotation is ignored.
+POSITION_TOLERANCE = 1e-5
+ROTATION_TOLERANCE = 1e-5
+TIME_TOLERANCE = 1e-6
+
+# Japanese names of the body bones, plus a finger the converter doesn't use.
+SYNTHETIC_BONES = ['センター', '上半身', '首', '頭', '下半身', '左足', '右足', '右ひざ', '左ひざ', '右肩', '左肩',
+                   '左腕', '右腕', '左ひじ', '右ひじ', '右手首', '左手首', '左足首', '右足首', '左人指１']
+SYNTHETIC_IK_BONES = ['左足ＩＫ', '右足ＩＫ']
+
+# Bones whose motion ends within the first SHORT_MOTION_FRAMES frames, before WINDOW starts.
+SHORT_MOTION_BONES = ['右腕']
+SHORT_MOTION_FRAMES = 100
+
+
+@contextlib.contextmanager
+def settings(**values):
+    """Temporarily change settings in vmd.py, the reference reads them from there too."""
+    previous = dict((name, getattr(vmd, name)) for name in values)
+    for name, value in values.items():
+        setattr(vmd, name, value)
+    try:
+        yield
+    finally:
+        for name, value in previous.items():
+            setattr(vmd, name, value)
+
+
+def convert_vmd(motion_file, scene_base, steps_per_second=None, chunk_frames=None, start_frame=None,
+                end_frame=None, transforms=None):
+    """Convert a motion the way vmd.main does, returns the VAM scene json."""
+    motion_data = vmd.File()
+    motion_data.load(filepath=motion_file)
+    vam_body = vmd.Body(motion_data)
+    bone_state_calculator = vmd.BoneStateCalculator(motion_data, steps_per_second)
+    vam_scene = vmd.VamSceneFile(scene_base)
+    vam_animator = vmd.VamAnimator(vam_scene, start_frame or 0, transforms)
+    if chunk_frames:
+        for bone_state in bone_state_calculator.calculate_chunks(vam_body.get_body(), chunk_frames,
+                                                                 start_frame, end_frame):
+            vam_animator.add(bone_state, vam_body.get_uses_ik())
+        vam_animator.finish()
+    else:
+        bone_state = bone_state_calculator.calculate(vam_body.get_body(), start_frame, end_frame)
+        vam_animator.process(bone_state, vam_body.get_uses_ik())
+    return vam_scene.vam_json
+
+
+def convert_vmd_baked(motion_file, scene_base):
+    # A baked motion stores floats, so it only matches up to float precision.
+    motion_data = vmd.File()
+    motion_data.load(filepath=motion_file)
+    baked = vmd.MotionBaker(motion_data).bake(vmd.Body(motion_data).get_body())
+    baked_dir = tempfile.mkdtemp()
+    try:
+        baked_file = os.path.join(baked_dir, 'baked.vmd')
+        baked.save(filepath=baked_file)
+        _reset_body()
+        return convert_vmd(baked_file, scene_base)
+    finally:
+        shutil.rmtree(baked_dir)
+
+
+def convert_vmd_transforms_file(motion_file, scene_base):
+    # Spell out the transforms of TRANSFORMS_FILE_SETTINGS in a json file, vmd.py keeps its own settings.
+    values = TRANSFORMS_FILE_SETTINGS
+    arm = values['MMD_ARM_ROTATION']
+    specs = {'hip': {'offset': [0, values['MMD_CENTER_HEIGHT_OFFSET'], values['MMD_CENTER_Z_OFFSET']]}}
+    for bone in ('rArm', 'rElbow', 'rHand'):
+        specs[bone] = {'post': {'angle': arm, 'axis': [0, 0, 1]}}
+    for bone in ('lArm', 'lElbow', 'lHand'):
+        specs[bone] = {'post': {'angle': -arm, 'axis': [0, 0, 1]}}
+    for bone in ('rFoot', 'lFoot'):
+        specs[bone] = {'post': {'angle': -values['MMD_HEEL_ROTATION'], 'axis': [1, 0, 0]}} if values['HEELS'] else {}
+    transforms_dir = tempfile.mkdtemp()
+    try:
+        transforms_file = os.path.join(transforms_dir, 'transforms.json')
+        with open(transforms_file, 'w') as g:
+            json.dump(specs, g)
+        return convert_vmd(motion_file, scene_base, transforms=vmd.load_bone_transforms(transforms_file))
+    finally:
+        shutil.rmtree(transforms_dir)
+
+
+def convert_reference_transforms_settings(motion_file, scene_base):
+    with settings(**TRANSFORMS_FILE_SETTINGS):
+        return reference.convert(motion_file, scene_base)
+
+
+def get_animations(vam_json):
+    for atom in vam_json['atoms']:
+        if atom['id'] == vmd.ATOM_NAME:
+            return dict((s['id'], s['steps']) for s in atom['storables'] if s['id'].endswith('Animation'))
+    return {}
+
+
+def get_steps(vam_json, start_frame=0):
+    """
+    Steps of every bone by MMD frame (whole frames are ints), plus 'first' for the step at time 0 and 'off' for the
+    step turning the bone off.
+    """
+    steps = {}
+    for bone, animation in get_animations(vam_json).items():
+        steps[bone] = {}
+        # The first step is written twice, once at time 0 and once as the first frame.
+        if animation:
+            steps[bone]['first'] = animation[0]
+        for step in animation[2:]:
+            if 'position' not in step:
+                steps[bone]['off'] = step
+                continue
+            frame = (float(step['timeStep']) - vmd.TIME_PAD_SECONDS) * vmd.VAM_FPS + start_frame
+            if abs(frame - round(frame)) < 1e-6:
+                frame = int(round(frame))
+            steps[bone][frame] = step
+    return steps
+
+
+def _diff_step(label, e, a, max_diffs, problems, check_time=True):
+    if sorted(e.keys()) != sorted(a.keys()) or e.get('positionOn') != a.get('positionOn') \
+            or e.get('rotationOn') != a.get('rotationOn'):
+        problems.append('%s: %s instead of %s' % (label, a, e))
+        return
+    if check_time and abs(float(e['timeStep']) - float(a['timeStep'])) > TIME_TOLERANCE:
+        problems.append('%s: time %s instead of %s' % (label, a['timeStep'], e['timeStep']))
+    if 'position' in e:
+        pos = max([abs(float(e['position'][c]) - float(a['position'][c])) for c in 'xyz'])
+        max_diffs[0] = max(max_diffs[0], pos)
+        if pos > POSITION_TOLERANCE:
+            problems.append('%s: position %s instead of %s' % (label, a['position'], e['position']))
+    if 'rotation' in e:
+        same = max([abs(float(e['rotation'][c]) - float(a['rotation'][c])) for c in 'xyzw'])
+        flipped = max([abs(float(e['rotation'][c]) + float(a['rotation'][c])) for c in 'xyzw'])
+        rot = min(same, flipped)
+        max_diffs[1] = max(max_diffs[1], rot)
+        if rot > ROTATION_TOLERANCE:
+            problems.append('%s: rotation %s instead of %s' % (label, a['rotation'], e['rotation']))
+
+
+def _interpolate_step(before, after, amount):
+    """Step between two steps: positions are interpolated linearly and rotations with slerp."""
+    step = dict(after)
+    if 'position' in before:
+        step['position'] = dict((c, str(float(before['position'][c]) * (1 - amount) +
+                                        float(after['position'][c]) * amount)) for c in 'xyz')
+    if 'rotation' in before:
+        q0, q1 = [Quaternion(*[float(s['rotation'][c]) for c in 'wxyz']) for s in (before, after)]
+        q = Quaternion.slerp(q0, q1, amount)
+        step['rotation'] = dict((c, str(getattr(q, c))) for c in 'xyzw')
+    return step
+
+
+def _diff_bones(expected, actual, problems):
+    if sorted(expected.keys()) != sorted(actual.keys()):
+        problems.append('bones differ: %s vs %s' % (sorted(expected.keys()), sorted(actual.keys())))
+
+
+def diff_scenes(expected, actual):
+    """Same scene, step by step. Returns (max position diff, max rotation diff, list of problems)."""
+    max_diffs = [0.0, 0.0]
+    problems = []
+    expected_animations = get_animations(expected)
+    actual_animations = get_animations(actual)
+    _diff_bones(expected_animations, actual_animations, problems)
+    for bone, expected_steps in expected_animations.items():
+        actual_steps = actual_animations.get(bone, [])
+        if len(expected_steps) != len(actual_steps):
+            problems.append('%s: %d steps instead of %d' % (bone, len(actual_steps), len(expected_steps)))
+            continue
+        for i, (e, a) in enumerate(zip(expected_steps, actual_steps)):
+            _diff_step('%s step %d' % (bone, i), e, a, max_diffs, problems)
+    if [a for a in expected['atoms'] if a['id'] == 'CoreControl'] != \
+            [a for a in actual['atoms'] if a['id'] == 'CoreControl']:
+        problems.append('CoreControl differs')
+    return max_diffs[0], max_diffs[1], problems
+
+
+def diff_resampled(steps_per_second):
+    """
+    Resampled scene against a frame by frame one. Steps landing on a whole frame must match the step of that frame,
+    and no whole frame of the step grid may be missing. The resampler lerps positions and slerps rotations in between
+    frames, so steps in between two frames must match the same interpolation of the steps of both frames.
+    """
+    frame_step = vmd.VAM_FPS / steps_per_second
+
+    def diff(expected, actual):
+        max_diffs = [0.0, 0.0]
+        problems = []
+        expected_steps = get_steps(expected)
+        actual_steps = get_steps(actual)
+        _diff_bones(expected_steps, actual_steps, problems)
+        for bone, expected_frames in expected_steps.items():
+            actual_frames = actual_steps.get(bone, {})
+            for key in ('first', 'off'):
+                if (key in expected_frames) != (key in actual_frames):
+                    problems.append('%s: %s step missing' % (bone, key))
+                elif key in expected_frames:
+                    _diff_step('%s %s step' % (bone, key), expected_frames[key], actual_frames[key], max_diffs,
+                               problems)
+            for frame, step in actual_frames.items():
+                if frame in ('first', 'off'):
+                    continue
+                if not isinstance(frame, int):
+                    before = int(frame)
+                    # Frame 0 is the first step, which doesn't hold the frame's position.
+                    if before == 0:
+                        continue
+                    if before not in expected_frames or before + 1 not in expected_frames:
+                        problems.append('%s frame %s: not in between reference frames' % (bone, frame))
+                        continue
+                    e = _interpolate_step(expected_frames[before], expected_frames[before + 1], frame - before)
+                    e['timeStep'] = step['timeStep']
+                    _diff_step('%s frame %.3f' % (bone, frame), e, step, max_diffs, problems)
+                    continue
+                if frame not in expected_frames:
+                    problems.append('%s frame %d: not in the reference' % (bone, frame))
+                else:
+                    _diff_step('%s frame %d' % (bone, frame), expected_frames[frame], step, max_diffs, problems)
+            for frame in expected_frames:
+                if isinstance(frame, int) and abs(frame / frame_step - round(frame / frame_step)) < 1e-9 \
+                        and frame not in actual_frames:
+                    problems.append('%s frame %d: missing' % (bone, frame))
+        return max_diffs[0], max_diffs[1], problems
+    return diff
+
+
+def diff_window(start_frame, end_frame):
+    """
+    Window of a motion against the full one. Every bone starts the window with its pose at start_frame, which is
+    the last frame at or before it in the full scene (bones that stopped moving hold their pose). That step starts
+    from the VAM base position, so only its rotation is compared. The other steps in the window must match the
+    full scene's step of the same frame, with time steps shifted by start_frame.
+    """
+    def diff(expected, actual):
+        max_diffs = [0.0, 0.0]
+        problems = []
+        expected_steps = get_steps(expected)
+        actual_steps = get_steps(actual, start_frame)
+        _diff_bones(expected_steps, actual_steps, problems)
+        for bone, expected_frames in expected_steps.items():
+            if 'first' not in expected_frames:
+                continue
+            actual_frames = actual_steps.get(bone, {})
+            if 'first' not in actual_frames:
+                problems.append('%s: no steps in the window' % bone)
+                continue
+            # The first step of the full scene is frame 0.
+            frames = dict((f, s) for f, s in expected_frames.items() if isinstance(f, int))
+            frames[0] = expected_frames['first']
+            held = max([f for f in frames if f <= start_frame])
+            window = sorted([f for f in frames if start_frame < f <= end_frame])
+
+            first = dict(frames[held])
+            first['position'] = actual_frames['first']['position']
+            _diff_step('%s first step (frame %d)' % (bone, held), first, actual_frames['first'], max_diffs, problems,
+                       check_time=False)
+            actual_window = sorted([f for f in actual_frames if f not in ('first', 'off')])
+            if actual_window != window:
+                problems.append('%s: frames %s..%s instead of %s..%s' % (
+                    bone, actual_window[:1], actual_window[-1:], window[:1], window[-1:]))
+                continue
+            for frame in window:
+                e = dict(frames[frame])
+                e['timeStep'] = str(float(e['timeStep']) - start_frame / vmd.VAM_FPS)
+                _diff_step('%s frame %d' % (bone, frame), e, actual_frames[frame], max_diffs, problems)
+            if 'off' in expected_frames:
+                # Turned off right after the last frame in the window, not the last frame of the motion.
+                e = dict(expected_frames['off'])
+                e['timeStep'] = str(float((window[-1] if window else start_frame) - start_frame + 1/30.0))
+                if 'off' not in actual_frames:
+                    problems.append('%s: off step missing' % bone)
+                else:
+                    _diff_step('%s off step' % bone, e, actual_frames['off'], max_diffs, problems)
+        return max_diffs[0], max_diffs[1], problems
+    return diff
+
+
+# (engine name, function(motion_file, scene_base) returning the VAM scene json, name of the engine it's compared
+# with, diff function). Engines without a diff function are only run for others to compare with. Add new engines
+# here.
+ENGINES = [
+    ('vmd', convert_vmd, 'reference', diff_scenes),
+    ('vmd chunked', lambda m, s: convert_vmd(m, s, chunk_frames=CHUNK_FRAMES), 'reference', diff_scenes),
+    # At the MMD frame rate every step lands on a frame, so the resampler must match frame by frame.
+    ('vmd 30 steps/s', lambda m, s: convert_vmd(m, s, vmd.VAM_FPS), 'reference', diff_scenes),
+    ('vmd 15 steps/s', lambda m, s: convert_vmd(m, s, 15), 'reference', diff_resampled(15)),
+    ('vmd 15 chunked', lambda m, s: convert_vmd(m, s, 15, CHUNK_FRAMES), 'vmd 15 steps/s', diff_scenes),
+    ('vmd 24 steps/s', lambda m, s: convert_vmd(m, s, 24), 'reference', diff_resampled(24)),
+    ('vmd 24 chunked', lambda m, s: convert_vmd(m, s, 24, CHUNK_FRAMES), 'vmd 24 steps/s', diff_scenes),
+    ('vmd 60 steps/s', lambda m, s: convert_vmd(m, s, 60), 'reference', diff_resampled(60)),
+    ('vmd 60 chunked', lambda m, s: convert_vmd(m, s, 60, CHUNK_FRAMES), 'vmd 60 steps/s', diff_scenes),
+    ('vmd window', lambda m, s: convert_vmd(m, s, start_frame=WINDOW[0], end_frame=WINDOW[1]), 'reference',
+     diff_window(*WINDOW)),
+    ('vmd window chunked', lambda m, s: convert_vmd(m, s, chunk_frames=CHUNK_FRAMES, start_frame=WINDOW[0],
+                                                    end_frame=WINDOW[1]), 'vmd window', diff_scenes),
+    ('reference tweaked', convert_reference_transforms_settings, None, None),
+    ('vmd transforms file', convert_vmd_transforms_file, 'reference tweaked', diff_scenes),
+    ('vmd baked', convert_vmd_baked, 'reference', diff_scenes),
+]
+
+
+_BODY_DEPS = dict(vmd.Body.DEPS)
+_REFERENCE_BODY_DEPS = dict(reference.Body.DEPS)
+
+
+def _reset_body():
+    # Body adds the feet to DEPS when a motion has no IK, don't let that leak into the next motion.
+    vmd.Body.DEPS = dict(_BODY_DEPS)
+    reference.Body.DEPS = dict(_REFERENCE_BODY_DEPS)
+
+
+def make_synthetic_motion(path, seed, uses_ik):
+    rnd = random.Random(seed)
+    motion = reference.File()
+    motion.header = reference.Header()
+    motion.header.model_name = 'synthetic'
+    motion.boneAnimation = reference.BoneAnimation()
+    for bone in SYNTHETIC_BONES + (SYNTHETIC_IK_BONES if uses_ik else []):
+        # Some bones barely move, some have a key every few frames. All start at frame 0.
+        if bone in SHORT_MOTION_BONES:
+            frames = [0] + [rnd.randint(1, SHORT_MOTION_FRAMES) for i in range(rnd.choice([1, 5, 20]))]
+        else:
+            frames = [0] + [rnd.randint(0, SYNTHETIC_FRAMES) for i in range(rnd.choice([0, 1, 5, 20, 60]))]
+        for frame_number in sorted(frames):
+            boneFrameKey = reference.BoneFrameKey()
+            boneFrameKey.frame_number = frame_number
+            boneFrameKey.location = [rnd.uniform(-10, 10) for i in range(3)]
+            if frame_number == 0 and rnd.random() < 0.2:
+                boneFrameKey.rotation = [0, 0, 0, 1]
+            else:
+                q = [rnd.gauss(0, 1) for i in range(4)]
+                norm = sum([c * c for c in q]) ** 0.5
+                boneFrameKey.rotation = [c / norm for c in q]
+            boneFrameKey.interp = [20] * 64
+            motion.boneAnimation[bone].append(boneFrameKey)
+    motion.save(filepath=path)
+
+
+def get_corpus(work_dir):
+    corpus = []
+    for i in range(SYNTHETIC_MOTIONS):
+        path = os.path.join(work_dir, 'synthetic%d.vmd' % i)
+        make_synthetic_motion(path, i, i % 2 == 1)
+        corpus.append(path)
+    if SAMPLE_MOTIONS_DIR:
+        corpus.extend(sorted([os.path.join(SAMPLE_MOTIONS_DIR, f) for f in os.listdir(SAMPLE_MOTIONS_DIR)
+                              if f.lower().endswith('.vmd')]))
+    corpus.extend(sys.argv[1:])
+    return corpus
+
+
+def check_chunked_resampling(motion_file, devnull):
+    """Chunked resampling has to give the same step frames as resampling all at once."""
+    problems = []
+    for steps_per_second in RESAMPLING_RATES:
+        _reset_body()
+        motion_data = vmd.File()
+        motion_data.load(filepath=motion_file)
+        body = vmd.Body(motion_data).get_body()
+        with contextlib.redirect_stdout(devnull):
+            full = vmd.BoneStateCalculator(motion_data, steps_per_second).calculate(body)
+            chunked = {}
+            bone_state_calculator = vmd.BoneStateCalculator(motion_data, steps_per_second)
+            for bone_state in bone_state_calculator.calculate_chunks(body, CHUNK_FRAMES):
+                for bone, state in bone_state.items():
+                    chunked.setdefault(bone, []).extend(sorted(state.keys()))
+        for bone, state in full.items():
+            if sorted(state.keys()) != chunked.get(bone, []):
+                missing = sorted(set(state.keys()) - set(chunked.get(bone, [])))
+                problems.append('%s at %s steps/s: chunked steps differ, missing %s' % (
+                    bone, steps_per_second, missing[:5]))
+    return problems
+
+
+def run(engine, motion_file, devnull):
+    best = None
+    for i in range(REPEATS):
+        _reset_body()
+        start = time.time()
+        with contextlib.redirect_stdout(devnull):
+            vam_json = engine(motion_file, VAM_SCENE_BASE)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return vam_json, best
+
+
+def report(name, problems, line=''):
+    print('  %-20s %s%s' % (name, line, 'FAIL' if problems else 'ok'))
+    for problem in problems[:5]:
+        print('    ' + problem)
+    return bool(problems)
+
+
+def main():
+    work_dir = tempfile.mkdtemp()
+    failed = False
+    try:
+        with open(os.devnull, 'w') as devnull:
+            for motion_file in get_corpus(work_dir):
+                print(os.path.basename(motion_file))
+                scenes = {}
+                scenes['reference'], reference_time = run(reference.convert, motion_file, devnull)
+                print('  %-20s %8.3fs' % ('reference', reference_time))
+                for name, engine, expected, diff in ENGINES:
+                    scenes[name], elapsed = run(engine, motion_file, devnull)
+                    if diff is None:
+                        print('  %-20s %8.3fs' % (name, elapsed))
+                        continue
+                    max_pos, max_rot, problems = diff(scenes[expected], scenes[name])
+                    failed = report(name, problems, '%8.3fs  x%-6.2f pos %.1e  rot %.1e  vs %-18s ' % (
+                        elapsed, reference_time / max(elapsed, 1e-9), max_pos, max_rot, expected)) or failed
+                failed = report('chunked steps', check_chunked_resampling(motion_file, devnull)) or failed
+    finally:
+        shutil.rmtree(work_dir)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 import struct
 import collections
+import bisect
 import json
 
+import numpy as np
 from pyquaternion import Quaternion
 
 '''
@@ -26,6 +28,10 @@ VAM_SCENE_BASE = ''
 # VAM output file location (e.g. 'C:\\Users\\myuser\\Desktop\\out.json')
 VAM_OUT_SCENE = ''
 
+# Set to a .vmd file location (e.g. 'C:\\Users\\myuser\\Desktop\\baked.vmd') to bake the motion instead of
+# converting it. Every frame gets a keyframe with the interpolated bone positions and rotations.
+MMD_BAKED_FILE = ''
+
 # VAM position units are bigger than MMD (e.g. the distance of y to y + 1 is longer by ~12x)
 POSITION_FACTOR = 0.08
 
@@ -36,6 +42,10 @@ TIME_PAD_SECONDS = 1
 # Increasing this won't help FPS as VAM already interpolates.
 VAM_FPS = 30.0
 
+# Animation steps per second written to the scene. Lower it (e.g. 15) for smaller scenes that load faster, raise it
+# (e.g. 60) for smoother motion. None writes one step per MMD frame.
+VAM_STEPS_PER_SECOND = None
+
 # VAM start position for arms is 90deg from chest but MMD arms are slightly rotated towards ground.
 MMD_ARM_ROTATION = 0.8 # 30 deg
 
@@ -54,6 +64,20 @@ MMD_CENTER_HEIGHT_OFFSET = -0.05
 # hip (center) offset position forwards/backwards. Modify this if model's hips seem too forward or too behind.
 MMD_CENTER_Z_OFFSET = -0.00
 
+# Only convert the frames within this range (both included), None for the start / end of the motion.
+# Handy to preview part of a long motion, e.g. seconds 30 to 45 are frames 900 to 1350 (MMD is 30 FPS).
+MMD_START_FRAME = None
+MMD_END_FRAME = None
+
+# Interpolate the motion in chunks of this many frames instead of all at once, e.g. 1800 for one minute at a time.
+# Only the interpolated bone state is kept per chunk, the VAM steps of the whole motion still pile up until the
+# scene is written. None to disable.
+CHUNK_FRAMES = None
+
+# Json file with per bone transforms for other models (e.g. 'C:\\Users\\myuser\\Desktop\\transforms.json').
+# Bones in the file replace the transforms built from the settings above. See the README for the format.
+VAM_BONE_TRANSFORMS_FILE = ''
+
 # Name of the atom in which to insert animation.
 ATOM_NAME = 'Person'
 
@@ -295,6 +319,8 @@ class Header:
 
 
 class BoneFrameKey:
+    RECORD = struct.Struct('<L3f4f64b')
+
     def __init__(self):
         self.frame_number = 0
         self.location = []
@@ -313,6 +339,9 @@ class BoneFrameKey:
         fin.write(struct.pack('<ffff', *self.rotation))
         fin.write(struct.pack('<64b', *self.interp))
 
+    def pack_into(self, buffer, offset):
+        self.RECORD.pack_into(buffer, offset, self.frame_number, *self.location, *self.rotation, *self.interp)
+
     def __repr__(self):
         return '<BoneFrameKey frame %s, loa %s, rot %s>'%(
             str(self.frame_number),
@@ -322,8 +351,12 @@ class BoneFrameKey:
 
 
 class _AnimationBase(collections.defaultdict):
+    NAME = struct.Struct('<15s')
+
     def __init__(self):
         collections.defaultdict.__init__(self, list)
+        # Name as stored in the file for each translated name, so saving keeps the original japanese names.
+        self.raw_names = {}
 
     @staticmethod
     def frameClass():
@@ -332,20 +365,28 @@ class _AnimationBase(collections.defaultdict):
     def load(self, fin):
         count, = struct.unpack('<L', fin.read(4))
         for i in range(count):
-            name = translate_from_jp(_to_shift_jis_string(struct.unpack('<15s', fin.read(15))[0]))
+            raw_name, = self.NAME.unpack(fin.read(self.NAME.size))
+            name = translate_from_jp(_to_shift_jis_string(raw_name))
+            self.raw_names.setdefault(name, raw_name)
             cls = self.frameClass()
             frameKey = cls()
             frameKey.load(fin)
             self[name].append(frameKey)
 
     def save(self, fin):
+        # Pack all the records in a single buffer and write it at once, baked motions have a lot of them.
+        record_size = self.NAME.size + self.frameClass().RECORD.size
         count = sum([len(i) for i in self.values()])
-        fin.write(struct.pack('<L', count))
+        buffer = bytearray(4 + count * record_size)
+        struct.pack_into('<L', buffer, 0, count)
+        offset = 4
         for name, frameKeys in self.items():
-            name_data = struct.pack('<15s', name.encode('shift_jis'))
+            name_data = self.raw_names.get(name) or name.encode('shift_jis')
             for frameKey in frameKeys:
-                fin.write(name_data)
-                frameKey.save(fin)
+                self.NAME.pack_into(buffer, offset, name_data)
+                frameKey.pack_into(buffer, offset + self.NAME.size)
+                offset += record_size
+        fin.write(buffer)
 
 
 class _AnimationListBase(list):
@@ -516,141 +557,507 @@ class Body:
         return self.uses_ik
 
 
+class BoneTrack:
+    """
+    Keyframes of a single bone, ready to be sampled at any frame.
+
+    Only the state at each keyframe is kept (absolute rotation and position), frames in between are interpolated
+    on demand. This way a few seconds of a long motion can be calculated without going through all of it.
+    """
+
+    def __init__(self, bone_name, frames, parent=None):
+        # A parent without any keyframes can't rotate its children.
+        if parent and not parent.keys:
+            parent = None
+        self.bone_name = bone_name
+        self.parent = parent
+        self.keys = []
+        self.frame_numbers = []
+        self.positions = []
+        self.rotations = []
+        # Absolute rotation of every keyframe as seen from the frames before it (parent rotation * child rotation).
+        self.targets = []
+        self.first_rot_on = True
+
+        for boneFrameKey in sorted(frames, key=lambda g: g.frame_number):
+            # Keys on a frame that's already known are ignored, the first one wins.
+            if self.frame_numbers and boneFrameKey.frame_number == self.frame_numbers[-1]:
+                continue
+            self.keys.append(boneFrameKey)
+            self.frame_numbers.append(boneFrameKey.frame_number)
+
+        if not self.keys:
+            return
+
+        first = self.keys[0]
+        # If all the rotation data is 0 (null rotation) then set the rotation to off for this bone at frame 0.
+        if first.rotation[0] == 0 and first.rotation[1] == 0 and first.rotation[2] == 0:
+            self.first_rot_on = False
+        # Get the initial rotation, if bone has a parent then add the first frame rotation with the parent.
+        q = Quaternion(first.rotation[3], first.rotation[0], first.rotation[1], first.rotation[2])
+        if parent:
+            q = parent.rotation_at(0) * q
+        self.positions.append({'x': first.location[0], 'y': first.location[1], 'z': first.location[2]})
+        self.rotations.append(q)
+        self.targets.append(q)
+
+        for i in range(1, len(self.keys)):
+            boneFrameKey = self.keys[i]
+            # The parent rotation at the keyframe, or at its last known frame before that.
+            if parent:
+                rot_next_frame_parent = parent.rotation_at(parent.floor_frame(boneFrameKey.frame_number))
+            else:
+                rot_next_frame_parent = Quaternion(1, 0, 0, 0)
+            rot_next_frame_child_relative = Quaternion(boneFrameKey.rotation[3],
+                                                       boneFrameKey.rotation[0],
+                                                       boneFrameKey.rotation[1],
+                                                       boneFrameKey.rotation[2])
+            self.targets.append(rot_next_frame_parent * rot_next_frame_child_relative)
+            # Store the keyframe itself as the last interpolated frame of its segment.
+            self.positions.append(self._interpolate_position(i, boneFrameKey.frame_number))
+            self.rotations.append(self._interpolate_rotation(i, boneFrameKey.frame_number))
+
+    @property
+    def last_frame(self):
+        # A bone with a single keyframe only has a state at frame 0.
+        if len(self.frame_numbers) > 1:
+            return self.frame_numbers[-1]
+        return 0
+
+    def has_motion(self):
+        return len(self.frame_numbers) > 1
+
+    def frames_between(self, start_frame, end_frame, include_end=True):
+        """Frames with a state for this bone, from start_frame up to end_frame (included unless include_end is off)."""
+        if not self.keys:
+            return []
+        if not include_end:
+            end_frame = end_frame - 1
+        frames = [0] if start_frame <= 0 <= end_frame else []
+        if len(self.frame_numbers) > 1:
+            frames.extend(range(max(self.frame_numbers[0] + 1, start_frame), min(self.last_frame, end_frame) + 1))
+        return frames
+
+    def floor_frame(self, frame):
+        """The closest frame at or before the given one which has a state for this bone."""
+        if frame >= self.last_frame:
+            return self.last_frame
+        if frame > self.frame_numbers[0]:
+            return frame
+        return 0
+
+    def _segment(self, frame):
+        # Index of the keyframe closing the segment the frame belongs to, i.e. frame in (key[i - 1], key[i]].
+        return bisect.bisect_left(self.frame_numbers, frame)
+
+    def _interpolate_position(self, i, frame):
+        # Use simple math to calculate where the intermediate points would be.
+        last_frame = self.frame_numbers[i - 1]
+        diff = self.frame_numbers[i] - last_frame
+        prev = self.positions[i - 1]
+        location = self.keys[i].location
+        return {
+            'x': prev['x'] * (diff - (frame - last_frame))/diff + (location[0] * (frame - last_frame)/diff),
+            'y': prev['y'] * (diff - (frame - last_frame))/diff + (location[1] * (frame - last_frame)/diff),
+            'z': prev['z'] * (diff - (frame - last_frame))/diff + (location[2] * (frame - last_frame)/diff),
+        }
+
+    def _interpolate_rotation(self, i, frame):
+        # Slerp between the rotation stored for the previous keyframe and the absolute rotation of the next one.
+        last_frame = self.frame_numbers[i - 1]
+        factor = float(1 / (self.frame_numbers[i] - last_frame))
+        return Quaternion.slerp(self.rotations[i - 1], self.targets[i], (frame - last_frame) * factor)
+
+    def rotation_at(self, frame):
+        if frame == 0:
+            return self.rotations[0]
+        i = self._segment(frame)
+        if self.frame_numbers[i] == frame:
+            return self.rotations[i]
+        return self._interpolate_rotation(i, frame)
+
+    def state_at(self, frame):
+        if frame == 0:
+            state = {'pos': self.positions[0], 'rot': self.rotations[0]}
+            if not self.first_rot_on:
+                state['rot_on'] = False
+            return state
+        i = self._segment(frame)
+        if self.frame_numbers[i] == frame:
+            return {'pos': self.positions[i], 'rot_on': True, 'rot': self.rotations[i]}
+        return {
+            'pos': self._interpolate_position(i, frame),
+            'rot_on': True,
+            'rot': self._interpolate_rotation(i, frame),
+        }
+
+
+def _slerp(q0, q1, amount):
+    """Row by row spherical linear interpolation of two (n, 4) quaternion arrays, same math as Quaternion.slerp."""
+    q0 = q0 / np.linalg.norm(q0, axis=1)[:, None]
+    q1 = q1 / np.linalg.norm(q1, axis=1)[:, None]
+    amount = np.clip(amount, 0, 1)[:, None]
+    dot = np.sum(q0 * q1, axis=1)[:, None]
+    # Take the shorter path, v1 and -v1 are the same rotation.
+    q0 = np.where(dot < 0.0, -q0, q0)
+    dot = np.abs(dot)
+    linear = dot > 0.9995
+
+    theta_0 = np.arccos(np.clip(dot, 0, 1))
+    sin_theta_0 = np.where(linear, 1.0, np.sin(theta_0))
+    theta = theta_0 * amount
+    s0 = np.cos(theta) - dot * np.sin(theta) / sin_theta_0
+    s1 = np.sin(theta) / sin_theta_0
+    qr = np.where(linear, q0 + amount * (q1 - q0), s0 * q0 + s1 * q1)
+    return qr / np.linalg.norm(qr, axis=1)[:, None]
+
+
+class Resampler:
+    """
+    Samples bone tracks at a fixed number of steps per second instead of once per MMD frame.
+
+    Steps usually fall in between two MMD frames, so positions are lerped and rotations slerped between the
+    keyframes around each step. All the steps of a bone are calculated at once.
+    """
+
+    def __init__(self, steps_per_second):
+        # MMD frames between two steps. Steps are aligned to frame 0, so they don't depend on the window.
+        self.frame_step = VAM_FPS / steps_per_second
+        self.arrays = {}
+
+    def get_arrays(self, track):
+        if track not in self.arrays:
+            rotations = [r.elements for r in track.rotations]
+            targets = [r.elements for r in track.targets]
+            self.arrays[track] = (
+                np.array(track.frame_numbers, dtype=float),
+                np.array([[p['x'], p['y'], p['z']] for p in track.positions]).reshape(-1, 3),
+                np.array([k.location for k in track.keys], dtype=float).reshape(-1, 3),
+                np.array(rotations).reshape(-1, 4),
+                np.array(targets).reshape(-1, 4),
+            )
+        return self.arrays[track]
+
+    def frames_between(self, track, start_frame, end_frame, include_end=True):
+        """
+        Step frames with a state for this bone, from start_frame up to end_frame (included unless include_end is
+        off). Steps usually aren't whole frames, so chunks must not include their end or steps in between two chunks
+        would be lost.
+        """
+        if not track.keys:
+            return np.zeros(0)
+        if track.last_frame < end_frame:
+            end_frame = track.last_frame
+            include_end = True
+        first = int(np.ceil(start_frame / self.frame_step))
+        last = int(np.floor(end_frame / self.frame_step))
+        frames = np.arange(first, last + 1) * self.frame_step
+        if not include_end:
+            frames = frames[frames < end_frame]
+        # Same as frame by frame, nothing between frame 0 and the first keyframe.
+        frames = frames[(frames == 0) | (frames > track.frame_numbers[0])]
+        # Always end on the last keyframe so the bone reaches its final pose.
+        if start_frame <= track.last_frame and (track.last_frame < end_frame or include_end) \
+                and (len(frames) == 0 or frames[-1] != track.last_frame):
+            frames = np.append(frames, track.last_frame)
+        return frames
+
+    def sample(self, track, frames):
+        """Positions (n, 3) and rotations (n, 4, w first) of the bone at the given frames."""
+        frame_numbers, positions, locations, rotations, targets = self.get_arrays(track)
+        i = np.clip(np.searchsorted(frame_numbers, frames, side='left'), 1, max(len(frame_numbers) - 1, 1))
+        if len(frame_numbers) > 1:
+            factor = (frames - frame_numbers[i - 1]) / (frame_numbers[i] - frame_numbers[i - 1])
+            pos = positions[i - 1] * (1 - factor)[:, None] + locations[i] * factor[:, None]
+            rot = _slerp(rotations[i - 1], targets[i], factor)
+        else:
+            pos = np.zeros((len(frames), 3))
+            rot = np.zeros((len(frames), 4))
+        # Frame 0 and keyframes are known already.
+        i = np.minimum(np.searchsorted(frame_numbers, frames, side='left'), len(frame_numbers) - 1)
+        i = np.where(frames == 0, 0, i)
+        known = (frames == 0) | (frame_numbers[i] == frames)
+        pos[known] = positions[i[known]]
+        rot[known] = rotations[i[known]]
+        return pos, rot
+
+    def calculate(self, track, start_frame, end_frame, include_end=True):
+        frames = self.frames_between(track, start_frame, end_frame, include_end)
+        pos, rot = self.sample(track, frames)
+        state = {}
+        for frame, p, r in zip(frames.tolist(), pos.tolist(), rot.tolist()):
+            state[frame] = {'pos': {'x': p[0], 'y': p[1], 'z': p[2]}, 'rot': Quaternion(r)}
+            if frame != 0:
+                state[frame]['rot_on'] = True
+            elif not track.first_rot_on:
+                state[frame]['rot_on'] = False
+        return state
+
+
 class BoneStateCalculator:
 
-    def __init__(self, motion_data):
+    def __init__(self, motion_data, steps_per_second=None):
         self.md = motion_data
+        self.tracks = None
+        self.resampler = Resampler(steps_per_second) if steps_per_second else None
 
-    def calculate(self, body):
-        bone_state = {}
+    def get_tracks(self, body):
+        if self.tracks is not None:
+            return self.tracks
+        tracks = collections.OrderedDict()
         for bone in body:
-
             if bone in MMD_TO_VAM_BONE_MAPPINGS.keys():
                 bone_name = MMD_TO_VAM_BONE_MAPPINGS[bone]
-                frames = self.md.boneAnimation[bone]
-                bone_state[bone_name] = {}
-                last_frame = -1
 
                 bone_dep = None
                 if bone_name in Body.DEPS.keys():
                     bone_dep = Body.DEPS[bone_name]
                     # Sometimes a dep wont have any info, so take the dep of the dep.
                     # E.g. Foot depends on knee, but knee has no motion info so use thigh as the dep.
-                    while bone_dep not in bone_state.keys() or len(bone_state[bone_dep].keys()) <= 1:
+                    while bone_dep not in tracks.keys() or not tracks[bone_dep].has_motion():
                         if bone_dep == 'hip':
                             break
                         bone_dep = Body.DEPS[bone_dep]
-                frames.sort(key=lambda g: g.frame_number)
 
                 print('Calculating motion for: ' + bone_name)
-                for boneFrameKey in frames:
-                    if last_frame == -1:
-                        # This is the first frame
-                        bone_state[bone_name][0] = {}
-                        bone_state[bone_name][0]['pos'] = {
-                            'x':  boneFrameKey.location[0],
-                            'y': boneFrameKey.location[1],
-                            'z': boneFrameKey.location[2]
-                        }
-                        # If all the rotation data is 0 (null rotation) then set the rotation to off for this bone
-                        # at frame 0.
-                        if boneFrameKey.rotation[0] == 0 and boneFrameKey.rotation[1] == 0\
-                                and boneFrameKey.rotation[2] == 0:
-                            bone_state[bone_name][0]['rot_on'] = False
-                        # Get the initial rotation
-                        q = Quaternion(boneFrameKey.rotation[3],
-                                       boneFrameKey.rotation[0],
-                                       boneFrameKey.rotation[1],
-                                       boneFrameKey.rotation[2])
-
-                        # If bone has a parent then add the first frame rotation with the parent.
-                        if bone_dep:
-                            q = bone_state[bone_dep][0]['rot'] * q
-                        bone_state[bone_name][0]['rot'] = q
-
-                    else:
-                        # Try to calculate the positions and rotations between frames via interpolation.
-                        for current_frame in range(last_frame + 1, boneFrameKey.frame_number + 1):
-                            bone_state[bone_name][current_frame] = {}
-                            diff = boneFrameKey.frame_number - last_frame
-
-                            # Use simple math to calculate where the intermediate points would be.
-                            factor = float(1/ diff)
-                            bone_state[bone_name][current_frame]['pos'] = {
-                                'x': bone_state[bone_name][last_frame]['pos']['x'] *
-                                     (diff - (current_frame - last_frame))/diff +
-                                     (boneFrameKey.location[0]* (current_frame - last_frame)/diff),
-                                'y': bone_state[bone_name][last_frame]['pos']['y'] *
-                                     (diff - (current_frame - last_frame))/diff +
-                                     (boneFrameKey.location[1]* (current_frame - last_frame)/diff),
-                                'z': bone_state[bone_name][last_frame]['pos']['z'] *
-                                     (diff - (current_frame - last_frame))/diff +
-                                     (boneFrameKey.location[2]* (current_frame - last_frame)/diff),
-                            }
-
-                            # This is the tricky part. The calculation for a rotation goes as follows:
-                            # 1. Find the rotation of the parent bone at this frame. Should be a quaternion.
-                            # 2. If not found, go to the previous frame until one is found.
-                            # 3. If the parent is not found at all just start with a null rotation for the dep.
-                            # 4. If it's not null then turn on rotation, put the rotation it in a new quaternion.
-                            # 5. Calculate the absolute rotation of the next frame by adding the parent and the
-                            #    child's rot.
-                            # 6. Get the absolute rotation that was already stored previously.
-                            # 7. Use the slerp function to interpolate the current rotation based on both previous and
-                            #    next rotations.
-                            # 8. Save the calculated rotation, and proceed to the next frame.
-                            rot_next_frame_parent = None
-
-                            if bone_name in Body.DEPS.keys():
-                                fr = boneFrameKey.frame_number
-                                while not rot_next_frame_parent:
-                                    try:
-                                        # 1
-                                        rot_next_frame_parent = bone_state[bone_dep][fr]['rot']
-                                    except KeyError:  # 2
-                                        fr = fr - 1
-                            if not rot_next_frame_parent:
-                                rot_next_frame_parent = Quaternion(1,0, 0, 0)  # 3
-
-                            bone_state[bone_name][current_frame]['rot_on'] = True
-                            # 4
-                            rot_next_frame_child_relative = Quaternion(boneFrameKey.rotation[3],
-                                                                       boneFrameKey.rotation[0],
-                                                                       boneFrameKey.rotation[1],
-                                                                       boneFrameKey.rotation[2])
-                            # 5
-                            rot_next_frame = rot_next_frame_parent * rot_next_frame_child_relative
-                            rot_prev_frame = bone_state[bone_name][last_frame]['rot']  # 6
-                            # 7
-                            rot_current_frame = \
-                                Quaternion.slerp(rot_prev_frame, rot_next_frame, (current_frame - last_frame) * factor)
-                            bone_state[bone_name][current_frame]['rot'] = rot_current_frame  # 8
-                    last_frame = boneFrameKey.frame_number
+                tracks[bone_name] = BoneTrack(bone_name, self.md.boneAnimation[bone], tracks.get(bone_dep))
             else:
                 print('Unknown body part: ' + bone)
+        self.tracks = tracks
+        return self.tracks
+
+    def calculate(self, body, start_frame=None, end_frame=None, include_end=True, hold_pose=True):
+        """
+        Interpolate every bone of the body frame by frame, or at every step when resampling. Optionally only the
+        frames from start_frame up to end_frame (included unless include_end is off) are calculated, keyframes
+        around that window are found by bisecting. With hold_pose, bones that aren't moving at start_frame (e.g.
+        their motion is already over) start the window with the pose they have at that point.
+        """
+        if start_frame is None:
+            start_frame = 0
+        if end_frame is None:
+            end_frame = max([t.last_frame for t in self.get_tracks(body).values()] or [0])
+        bone_state = {}
+        for bone_name, track in self.get_tracks(body).items():
+            bone_state[bone_name] = {}
+            if hold_pose and track.keys and 0 < start_frame <= end_frame \
+                    and track.floor_frame(start_frame) != start_frame:
+                bone_state[bone_name][start_frame] = track.state_at(track.floor_frame(start_frame))
+            if self.resampler:
+                bone_state[bone_name].update(self.resampler.calculate(track, start_frame, end_frame, include_end))
+                continue
+            for frame in track.frames_between(start_frame, end_frame, include_end):
+                bone_state[bone_name][frame] = track.state_at(frame)
         return bone_state
 
+    def calculate_chunks(self, body, chunk_frames, start_frame=None, end_frame=None):
+        """
+        Same as calculate, but yields the bone state in windows of chunk_frames frames so only one window of bone
+        state is in memory at a time (VamAnimator still keeps all the steps). Each window stops right before the next
+        one starts, only the last one includes end_frame.
+        """
+        if start_frame is None:
+            start_frame = 0
+        if end_frame is None:
+            end_frame = max([t.last_frame for t in self.get_tracks(body).values()] or [0])
+        for chunk_start in range(start_frame, end_frame + 1, chunk_frames):
+            # Only the first chunk starts the scene, so only that one holds poses.
+            hold_pose = chunk_start == start_frame
+            if chunk_start + chunk_frames > end_frame:
+                yield self.calculate(body, chunk_start, end_frame, hold_pose=hold_pose)
+            else:
+                yield self.calculate(body, chunk_start, chunk_start + chunk_frames, False, hold_pose)
+
+
+class MotionBaker:
+    """
+    Saves the motion as MMD would after registering every bone on every frame, i.e. one keyframe per frame holding
+    the interpolated position and rotation. Bones outside of the body are copied as they are.
+    """
+
+    # Default (linear) MMD interpolation curves.
+    LINEAR_INTERP = [20, 20, 0, 0, 20, 20, 20, 20, 107, 107, 107, 107, 107, 107, 107, 107,
+                     20, 20, 20, 20, 20, 20, 20, 107, 107, 107, 107, 107, 107, 107, 107, 0,
+                     20, 20, 20, 20, 20, 20, 107, 107, 107, 107, 107, 107, 107, 107, 0, 0,
+                     20, 20, 20, 20, 20, 107, 107, 107, 107, 107, 107, 107, 107, 0, 0, 0]
+
+    def __init__(self, motion_data):
+        self.md = motion_data
+
+    def bake(self, body):
+        tracks = BoneStateCalculator(self.md).get_tracks(body)
+        baked = File()
+        baked.header = self.md.header
+        baked.boneAnimation = BoneAnimation()
+        baked.boneAnimation.raw_names = dict(self.md.boneAnimation.raw_names)
+
+        for bone, frames in self.md.boneAnimation.items():
+            if bone in body and bone in MMD_TO_VAM_BONE_MAPPINGS.keys():
+                track = tracks[MMD_TO_VAM_BONE_MAPPINGS[bone]]
+                print('Baking motion for: ' + bone)
+                baked.boneAnimation[bone] = [self.bake_frame(track, frame)
+                                             for frame in track.frames_between(0, track.last_frame)]
+            else:
+                baked.boneAnimation[bone] = list(frames)
+        return baked
+
+    def bake_frame(self, track, frame):
+        state = track.state_at(frame)
+        boneFrameKey = BoneFrameKey()
+        boneFrameKey.frame_number = frame
+        boneFrameKey.location = [state['pos']['x'], state['pos']['y'], state['pos']['z']]
+        if frame == 0:
+            boneFrameKey.rotation = list(track.keys[0].rotation)
+        else:
+            # VMD rotations are relative to the parent bone, so take the parent rotation out again.
+            rot = state['rot']
+            if track.parent:
+                rot = track.parent.rotation_at(track.parent.floor_frame(frame)).inverse * rot
+            boneFrameKey.rotation = [rot.elements[1], rot.elements[2], rot.elements[3], rot.elements[0]]
+        boneFrameKey.interp = list(self.LINEAR_INTERP)
+        return boneFrameKey
+
+
+def _quaternion_multiply(a, b):
+    """Hamilton product of (..., 4) quaternion arrays, w first."""
+    aw, ax, ay, az = np.moveaxis(np.asarray(a, dtype=float), -1, 0)
+    bw, bx, by, bz = np.moveaxis(np.asarray(b, dtype=float), -1, 0)
+    return np.stack([
+        aw * bw - ax * bx - ay * by - az * bz,
+        aw * bx + ax * bw + ay * bz - az * by,
+        aw * by - ax * bz + ay * bw + az * bx,
+        aw * bz + ax * by - ay * bx + az * bw,
+    ], axis=-1)
+
+
+class BoneTransform:
+    """
+    How a bone goes from MMD to VAM, applied to all the frames of the bone at once:
+      rotation = pre * rotation * post, then each (x, y, z, w) component is multiplied by sign.
+      position = position * scale + VAM base position + offset.
+    """
+
+    def __init__(self, pre=None, post=None, sign=(-1, 1, -1, 1), scale=None, offset=(0, 0, 0)):
+        # pre and post are quaternions (w, x, y, z), None to leave the rotation as it is.
+        self.pre = None if pre is None else np.array(pre, dtype=float)
+        self.post = None if post is None else np.array(post, dtype=float)
+        self.sign = np.array(sign, dtype=float)
+        if scale is None:
+            scale = (-POSITION_FACTOR, POSITION_FACTOR, -POSITION_FACTOR)
+        self.scale = np.array(scale, dtype=float)
+        self.offset = np.array(offset, dtype=float)
+
+    @staticmethod
+    def rotation(angle, axis):
+        return Quaternion(angle=angle, axis=axis).elements
+
+    @classmethod
+    def from_dict(cls, spec):
+        """
+        Transform from its json form. pre and post are either [w, x, y, z] or {"angle": radians, "axis": [x, y, z]},
+        all the fields are optional, e.g. {"post": {"angle": 0.8, "axis": [0, 0, 1]}, "offset": [0, -0.05, 0]}
+        """
+        args = dict(spec)
+        for key in ('pre', 'post'):
+            if isinstance(args.get(key), dict):
+                args[key] = cls.rotation(args[key]['angle'], args[key]['axis'])
+        return cls(**args)
+
+    def positions(self, pos, base, first_step=False):
+        moved = pos * self.scale
+        # The first step of a bone starts at the VAM base position.
+        if first_step:
+            moved[0] = base
+        return moved + base + self.offset
+
+    def rotations(self, rot):
+        """VAM (x, y, z, w) rotations from (w, x, y, z) MMD ones."""
+        if self.pre is not None:
+            rot = _quaternion_multiply(self.pre, rot)
+        if self.post is not None:
+            rot = _quaternion_multiply(rot, self.post)
+        return rot[:, [1, 2, 3, 0]] * self.sign
+
+
+def default_bone_transforms():
+    transforms = {}
+    # Add height and Z offsets to the center bone.
+    transforms['hip'] = BoneTransform(offset=(0, MMD_CENTER_HEIGHT_OFFSET, MMD_CENTER_Z_OFFSET))
+    # Left and right arms are initially rotated by a few degrees in MMD, compensate for that
+    for bone in ('rArm', 'rElbow', 'rHand'):
+        transforms[bone] = BoneTransform(post=BoneTransform.rotation(MMD_ARM_ROTATION, [0, 0, 1]))
+    for bone in ('lArm', 'lElbow', 'lHand'):
+        transforms[bone] = BoneTransform(post=BoneTransform.rotation(-MMD_ARM_ROTATION, [0, 0, 1]))
+    if HEELS:
+        for bone in ('rFoot', 'lFoot'):
+            transforms[bone] = BoneTransform(post=BoneTransform.rotation(-MMD_HEEL_ROTATION, [1, 0, 0]))
+    return transforms
+
+
+def load_bone_transforms(path):
+    """Read a json file of VAM bone name -> transform (see BoneTransform.from_dict)."""
+    with open(path, 'r') as g:
+        specs = json.load(g)
+    return dict((bone, BoneTransform.from_dict(spec)) for bone, spec in specs.items())
+
 
 class VamAnimator:
 
-    def __init__(self, vam_scene):
+    def __init__(self, vam_scene, start_frame=0, transforms=None):
         self.vam_scene =  vam_scene
+        self.transforms = default_bone_transforms()
+        if transforms:
+            self.transforms.update(transforms)
+        # Frame that plays right after the time pad, so a window of the motion doesn't start with a long pause.
+        self.start_frame = start_frame
+        self.steps = collections.OrderedDict()
+        self.last_frames = {}
+        self.longest_timestep = 1
 
     def process(self, bone_state, uses_ik):
-        longest_timestep = 1
+        self.add(bone_state, uses_ik)
+        self.finish()
+
+    def get_transform(self, bone):
+        if bone not in self.transforms:
+            self.transforms[bone] = BoneTransform()
+        return self.transforms[bone]
+
+    def add(self, bone_state, uses_ik):
+        """Convert the bone state to VAM steps. Can be called once per chunk, in order, before calling finish."""
         for bone in bone_state.keys():
             print('Converting to VAM format: ' + bone)
-            steps = []
+            steps = self.steps.setdefault(bone, [])
             frame_nums = sorted(bone_state[bone].keys())
+            if len(frame_nums) == 0:
+                continue
+            self.last_frames[bone] = frame_nums[len(frame_nums) - 1]
+            transform = self.get_transform(bone)
+            first_step = len(steps) == 0
+
+            # Get what position the bone is currently in VAM's base file
+            try:
+                position, rotation = self.vam_scene.get_current_pos_rot_from_control(bone)
+            except TypeError:
+                try:
+                    position, rotation = self.vam_scene.get_current_pos_rot(bone)
+                except:
+                    pass
+            base = np.array([float(position['x']), float(position['y']), float(position['z'])])
+
+            # Transform the whole track at once, then write it step by step.
+            positions = transform.positions(
+                np.array([[bone_state[bone][i]['pos'][c] for c in 'xyz'] for i in frame_nums]), base, first_step)
+            rotations = transform.rotations(np.array([bone_state[bone][i]['rot'].elements for i in frame_nums]))
 
-            for i in frame_nums:
+            for i, pos, rot in zip(frame_nums, positions.tolist(), rotations.tolist()):
                 animation = {}
 
                 # 30 seconds per frame
-                ts = float(i / VAM_FPS) + TIME_PAD_SECONDS
+                ts = float((i - self.start_frame) / VAM_FPS) + TIME_PAD_SECONDS
 
-                if ts > longest_timestep:
-                    longest_timestep = ts
+                if ts > self.longest_timestep:
+                    self.longest_timestep = ts
 
                 animation['timeStep'] = str(ts)
 
@@ -669,81 +1076,28 @@ class VamAnimator:
                 else:
                     animation['rotationOn'] = 'false'
 
-                # POSITIONS
-
-                # Set all initial positions according to the MMD file, multiply times factor to adjust.
-                animation['position'] = {
-                    'x' : str(bone_state[bone][i]['pos']['x'] * -POSITION_FACTOR),
-                    'y' : str(bone_state[bone][i]['pos']['y'] * POSITION_FACTOR),
-                    'z' : str(bone_state[bone][i]['pos']['z'] * -POSITION_FACTOR),
-                }
+                animation['position'] = {'x': str(pos[0]), 'y': str(pos[1]), 'z': str(pos[2])}
+                animation['rotation'] = {'x': str(rot[0]), 'y': str(rot[1]), 'z': str(rot[2]), 'w': str(rot[3])}
 
-                # Get what position the bone is currently in VAM's base file
-                try:
-                    position, rotation = self.vam_scene.get_current_pos_rot_from_control(bone)
-                except TypeError:
-                    try:
-                        position, rotation = self.vam_scene.get_current_pos_rot(bone)
-                    except:
-                        pass
-                if len(steps) == 0:
+                # The first step sets the VAM base position at time 0.
+                if first_step:
+                    first_step = False
                     animation['timeStep'] = str(0)
-                    animation['position']['x'] = str(float(position['x']))
-                    animation['position']['y'] = str(float(position['y']))
-                    animation['position']['z'] = str(float(position['z']))
                     steps.append(animation)
 
-                # Add the two positions together (VAM and MMD) to get final position
-                animation['position']['x'] = str(float(animation['position']['x']) + float(position['x']))
-                animation['position']['y'] = str(float(animation['position']['y']) + float(position['y']))
-                animation['position']['z'] = str(float(animation['position']['z']) + float(position['z']))
-
-                # ROTATIONS
-
-                # Get rotations for frame previously calculated
-                res_q = bone_state[bone][i]['rot']
-
-                # Left and right arms are initially rotated by a few degrees in MMD, compensate for that
-                if bone == 'rArm' or bone == 'rElbow' or bone == 'rHand':
-                    res_q = res_q * Quaternion(angle=MMD_ARM_ROTATION, axis=[0,0,1])
-                if bone == 'lArm' or bone == 'lElbow' or bone == 'lHand':
-                    res_q = res_q * Quaternion(angle=-MMD_ARM_ROTATION, axis=[0,0,1])
-
-                if HEELS and (bone == 'rFoot' or bone == 'lFoot'):
-                    res_q = res_q * Quaternion(angle=-MMD_HEEL_ROTATION, axis=[1,0,0])
-
-                # Add height offset to the center bone.
-                if bone == 'hip':
-                    animation['position']['y'] = str(float(animation['position']['y']) + MMD_CENTER_HEIGHT_OFFSET)
-
-                # Add Z offset to the center bone.
-                if bone == 'hip':
-                    animation['position']['z'] = str(float(animation['position']['z']) + MMD_CENTER_Z_OFFSET)
-
-                # Assign all the rotations, x and z are flipped for all bones so multiply times -1
-                animation['rotation'] = {}
-                animation['rotation']['x'] = str(res_q.elements[1]*-1)
-                animation['rotation']['y'] = str(res_q.elements[2])
-                animation['rotation']['z'] = str(res_q.elements[3]*-1)
-                animation['rotation']['w'] = str(res_q.elements[0])
-
-                # Except in arms and feet, so flip sign again
-                if bone == 'rArm' or bone == 'lArm' or bone == 'rElbow' \
-                        or bone == 'lElbow' or bone == 'rHand' or bone == 'lHand' or bone == 'lFoot' or bone == 'rFoot':
-                    animation['rotation']['z'] = str(res_q.elements[3] * -1)
-                    animation['rotation']['x'] = str(res_q.elements[1] * -1)
-
                 steps.append(animation)
 
+    def finish(self):
+        for bone, steps in self.steps.items():
             # Once a bone is done and there are no more motions, turn it off as other bones may have more data.
-            if bone != 'hip' and bone != 'lFoot' and bone != 'rFoot' and len(frame_nums) > 0:
+            if bone != 'hip' and bone != 'lFoot' and bone != 'rFoot' and bone in self.last_frames:
                 animation = {}
-                animation['timeStep'] =  str(float(frame_nums[len(frame_nums)- 1] + 1/30.0))
+                animation['timeStep'] =  str(float(self.last_frames[bone] - self.start_frame + 1/30.0))
                 animation['positionOn'] = 'false'
                 animation['rotationOn'] = 'false'
                 steps.append(animation)
             self.vam_scene.insert_in_vam(steps, bone)
-        self.vam_scene.insert_core_control(longest_timestep)
+        self.vam_scene.insert_core_control(self.longest_timestep)
 
 
 
@@ -752,14 +1106,35 @@ def main():
     print('Loading motion file...')
     motion_data.load(filepath=MMD_MOTION_FILE)
     vam_body = Body(motion_data)
-    bone_state_calculator = BoneStateCalculator(motion_data)
-    bone_state = bone_state_calculator.calculate(vam_body.get_body())
+    bone_state_calculator = BoneStateCalculator(motion_data, VAM_STEPS_PER_SECOND)
     vam_scene = VamSceneFile(VAM_SCENE_BASE)
-    vam_animator = VamAnimator(vam_scene)
-    vam_animator.process(bone_state, vam_body.get_uses_ik())
+    transforms = load_bone_transforms(VAM_BONE_TRANSFORMS_FILE) if VAM_BONE_TRANSFORMS_FILE else None
+    vam_animator = VamAnimator(vam_scene, MMD_START_FRAME or 0, transforms)
+    if CHUNK_FRAMES:
+        for bone_state in bone_state_calculator.calculate_chunks(vam_body.get_body(), CHUNK_FRAMES,
+                                                                 MMD_START_FRAME, MMD_END_FRAME):
+            vam_animator.add(bone_state, vam_body.get_uses_ik())
+        vam_animator.finish()
+    else:
+        bone_state = bone_state_calculator.calculate(vam_body.get_body(), MMD_START_FRAME, MMD_END_FRAME)
+        vam_animator.process(bone_state, vam_body.get_uses_ik())
     print('Writing to disk...')
     vam_scene.dump(VAM_OUT_SCENE)
 
 
+def bake():
+    motion_data = File()
+    print('Loading motion file...')
+    motion_data.load(filepath=MMD_MOTION_FILE)
+    vam_body = Body(motion_data)
+    baked = MotionBaker(motion_data).bake(vam_body.get_body())
+    print('Writing to disk...')
+    baked.save(filepath=MMD_BAKED_FILE)
+    print('Wrote ' + MMD_BAKED_FILE)
+
+
 if __name__ == '__main__':
-    main()
+    if MMD_BAKED_FILE:
+        bake()
+    else:
+        main()